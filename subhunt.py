@@ -4,23 +4,78 @@ SubHunt - fast subdomain enumeration from massive passive DNS datasets
 Author: Vahe Demirkhanyan
 """
 
+import os
+import re
 import sys
 import time
+import functools
 import random
 import string
+import queue
 import socket
+import asyncio
+import sqlite3
+import statistics
 import argparse
-from typing import Any, Iterable, Optional, Set, FrozenSet, List, Tuple, Dict
-from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import ipaddress
+import itertools
+import threading
+from collections import deque
+from typing import Any, Callable, Generator, Iterable, Optional, Set, List, Tuple, Dict
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from urllib.parse import urlparse
+from xml.sax.saxutils import escape as xml_escape
 
 import requests
 
+# resolved addresses, packed with inet_pton and sorted
+IPSet = Tuple[bytes, ...]
+# outcome of one lookup: an IPSet (empty for NXDOMAIN / NODATA), or None when
+# the lookup failed transiently (timeout, SERVFAIL, EAI_AGAIN) and proves nothing
+Lookup = Optional[IPSet]
+
+try:
+    import aiodns  # type: ignore
+except Exception:
+    aiodns = None
+
+# DNSResolver.getaddrinfo only exists from aiodns 3.2; older releases would
+# fail every lookup, so treat them as missing and use the thread pool instead
+if aiodns is not None and not hasattr(aiodns.DNSResolver, "getaddrinfo"):
+    aiodns = None
+
+try:
+    import ijson  # type: ignore
+except Exception:
+    ijson = None
+
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None
+
+try:
+    import requests_cache  # type: ignore
+except Exception:
+    requests_cache = None
+
 API_URL = "https://ip.thc.org/api/v1/lookup/subdomains"
 WAYBACK_CDX_URL = "https://web.archive.org/cdx/search/cdx"
 CRTSH_URL = "https://crt.sh/"
 
 CANDIDATE_KEYS = ("domain", "subdomain", "fqdn", "name", "host")
+CONTAINER_KEYS = ("subdomains", "results", "data", "items")
+HOST_KEYS = frozenset(CANDIDATE_KEYS + CONTAINER_KEYS)
+PAGE_STATE_KEYS = ("page_state", "next_page_state", "next", "cursor")
+
+# one dict lookup classifies the key a streamed JSON string sits under:
+# host key, or page-state key (its priority)
+ROLE_HOST = -1
+KEY_ROLES: Dict[str, int] = dict.fromkeys(HOST_KEYS, ROLE_HOST)
+KEY_ROLES.update((k, i) for i, k in enumerate(PAGE_STATE_KEYS))
+
+# one crt.sh name_value holds newline-separated names, possibly "*." wildcards
+CRTSH_NAME_RE = re.compile(r"^\s*(?:\*\.)?(\S*?[^\s.])\.*\s*$", re.M)
 
 MAX_RETRIES = 6
 BASE_BACKOFF_SEC = 0.6
@@ -29,10 +84,40 @@ TIMEOUT_SEC = 30
 
 TRANSIENT_STATUSES = {408, 425, 429, 500, 502, 503, 504}
 
+THC_PAGE_LIMIT = 500
+THC_PAGE_DELAY_SEC = 0.15
+STREAM_CHUNK_SIZE = 64 * 1024
+
 # DNS-live filter settings 
-DNS_WORKERS = 60
 MAX_INFLIGHT = 2500
 
+# concurrency is sized from the wildcard probes' RTT: qps * median RTT
+DEFAULT_DNS_QPS = 1200
+MIN_DNS_CONCURRENCY = 20
+MAX_DNS_CONCURRENCY = 500
+SLOW_RESOLVER_RTT_SEC = 0.3
+SLOW_RESOLVER_CONCURRENCY = 50
+PUBLIC_NAMESERVERS = ["8.8.8.8", "1.1.1.1"]
+
+# async resolver, used instead of the thread pool when aiodns is installed;
+# candidates are handed to its loop in batches, one wakeup per batch
+ASYNC_DNS_TIMEOUT_SEC = 2
+DNS_SUBMIT_BATCH = 64
+
+# learned wildcards below the target: once this many live hosts under the same
+# parent share an IP set, the parent itself is probed for a wildcard
+WILDCARD_LEARN_THRESHOLD = 3
+
+# results are written unflushed and pushed out every N hosts or before waiting
+OUTPUT_FLUSH_EVERY = 64
+
+# on-disk cache of DNS-live results, shared across runs
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "subhunt")
+DNS_CACHE_TTL_SEC = 3600
+DNS_CACHE_NEGATIVE_TTL_SEC = 600
+DNS_CACHE_FLUSH_EVERY = 500
+HTTP_CACHE_TTL_SEC = 3600
+
 # wayback/CDX source
 WAYBACK_LIMIT = 20000  # keep sane.. dNS-live filter handles "junk", but CDX can be huge
 
@@ -43,45 +128,60 @@ def die(msg: str, code: int = 1) -> None:
 
 
 def extract_domains(obj: Any) -> Iterable[str]:
-    if isinstance(obj, str):
-        yield obj
-        return
-    if isinstance(obj, list):
-        for item in obj:
-            yield from extract_domains(item)
-        return
-    if isinstance(obj, dict):
-        for k in CANDIDATE_KEYS:
-            v = obj.get(k)
-            if isinstance(v, str) and v.strip():
-                yield v.strip()
-        for k in ("subdomains", "results", "data", "items"):
-            v = obj.get(k)
-            if isinstance(v, (list, dict, str)):
-                yield from extract_domains(v)
-        for v in obj.values():
-            if isinstance(v, (list, dict)):
-                yield from extract_domains(v)
+    # iterative walk, each container visited once: strings are taken from list
+    # items and from dict values under HOST_KEYS, nested containers are pushed
+    stack = deque([obj])
+    while stack:
+        o = stack.pop()
+        t = type(o)
+        if t is dict:
+            for k, v in o.items():
+                tv = type(v)
+                if tv is str:
+                    if k in HOST_KEYS:
+                        v = v.strip()
+                        if v:
+                            yield v
+                elif tv is list or tv is dict:
+                    stack.append(v)
+        elif t is list:
+            for v in o:
+                tv = type(v)
+                if tv is str:
+                    yield v
+                elif tv is list or tv is dict:
+                    stack.append(v)
+        elif t is str:
+            yield o
 
 
 def find_next_page_state(obj: Any) -> Optional[str]:
-    if isinstance(obj, dict):
-        for k in ("page_state", "next_page_state", "next", "cursor"):
-            v = obj.get(k)
-            if isinstance(v, str) and v:
-                return v
-        for v in obj.values():
-            ps = find_next_page_state(v)
-            if ps:
-                return ps
-    elif isinstance(obj, list):
-        for v in obj:
-            ps = find_next_page_state(v)
-            if ps:
-                return ps
+    # same pre-order as a recursive walk: a dict's own keys win over its children
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        t = type(o)
+        if t is dict:
+            for k in PAGE_STATE_KEYS:
+                v = o.get(k)
+                if type(v) is str and v:
+                    return v
+            children = [v for v in o.values() if type(v) is dict or type(v) is list]
+        elif t is list:
+            children = [v for v in o if type(v) is dict or type(v) is list]
+        else:
+            continue
+        children.reverse()
+        stack.extend(children)
     return None
 
 
+def _load_json(r: requests.Response) -> Any:
+    if orjson is not None:
+        return orjson.loads(r.content)
+    return r.json()
+
+
 def _retry_after_seconds(resp: requests.Response) -> Optional[float]:
     ra = resp.headers.get("Retry-After")
     if not ra:
@@ -100,7 +200,79 @@ def _sleep_backoff(attempt: int, forced_min: Optional[float] = None) -> None:
     time.sleep(delay)
 
 
-def post_lookup(session: requests.Session, domain: str, limit: int, page_state: str) -> Any:
+def scan_thc_stream(chunks: Iterable[bytes]) -> Generator[str, None, Optional[str]]:
+    # single streaming pass over the raw body: yields hosts with the same
+    # rules as extract_domains as each chunk is parsed and returns the same
+    # page state as find_next_page_state, without ever building the JSON tree
+    page_state: Optional[str] = None
+
+    events = ijson.sendable_list()
+    parser = ijson.basic_parse_coro(events)
+
+    roles = KEY_ROLES
+    # open containers, innermost last: None for an array, else the map's
+    # current key; a string directly inside an array is a list item
+    open_containers: List[Optional[str]] = []
+    # per open container: the first page state found in a child, in document
+    # order, and (maps only) the map's own page-state values by priority
+    child_states: List[Optional[str]] = []
+    own_states: List[Optional[Dict[int, str]]] = []
+
+    def consume() -> Iterable[str]:
+        nonlocal page_state
+        for event, value in events:
+            if event == "string":
+                if not open_containers or open_containers[-1] is None:
+                    yield value
+                    continue
+                role = roles.get(open_containers[-1])
+                if role is None:
+                    continue
+                if role == ROLE_HOST:
+                    value = value.strip()
+                    if value:
+                        yield value
+                elif value:
+                    own = own_states[-1]
+                    if own is None:
+                        own = own_states[-1] = {}
+                    own[role] = value
+            elif event == "map_key":
+                open_containers[-1] = value
+                # a repeated key replaces the earlier value, as in a dict
+                own = own_states[-1]
+                if own is not None:
+                    own.pop(roles.get(value, ROLE_HOST), None)
+            elif event == "start_map" or event == "start_array":
+                open_containers.append("" if event == "start_map" else None)
+                child_states.append(None)
+                own_states.append(None)
+            elif event == "end_map" or event == "end_array":
+                open_containers.pop()
+                # a map's own keys win over anything below it
+                state = child_states.pop()
+                own = own_states.pop()
+                if own:
+                    state = own[min(own)]
+                if not child_states:
+                    page_state = state
+                elif child_states[-1] is None:
+                    child_states[-1] = state
+        del events[:]
+
+    for chunk in chunks:
+        parser.send(chunk)
+        yield from consume()
+    parser.close()
+    yield from consume()
+
+    return page_state
+
+
+def post_lookup(
+    session: requests.Session, domain: str, limit: int, page_state: str
+) -> Generator[str, None, Optional[str]]:
+    # yields the page's hosts as they are parsed and returns its next page_state
     payload = {"domain": domain, "limit": limit, "page_state": page_state}
     headers = {"Accept": "application/json", "User-Agent": "subhunt/1.5"}
 
@@ -108,21 +280,36 @@ def post_lookup(session: requests.Session, domain: str, limit: int, page_state:
 
     for attempt in range(MAX_RETRIES):
         try:
-            r = session.post(API_URL, json=payload, headers=headers, timeout=TIMEOUT_SEC)
+            r = session.post(API_URL, json=payload, headers=headers, timeout=TIMEOUT_SEC, stream=True)
         except requests.RequestException as e:
             last_err = f"Request error: {e}"
             _sleep_backoff(attempt)
             continue
 
         if 200 <= r.status_code < 300:
+            head = b""
             try:
-                return r.json()
+                if ijson is not None:
+                    chunks = r.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+                    head = next(chunks, b"")
+                    return (yield from scan_thc_stream(itertools.chain((head,), chunks)))
+                obj = _load_json(r)
+                yield from extract_domains(obj)
+                return find_next_page_state(obj)
+            except requests.RequestException as e:
+                last_err = f"Request error: {e}"
+                _sleep_backoff(attempt)
+                continue
             except Exception:
-                snippet = r.text[:200].replace("\n", "\\n")
+                text = head.decode("utf-8", "replace") if ijson is not None else r.text
+                snippet = text[:200].replace("\n", "\\n")
                 die(f"Unexpected response (not JSON). First 200 chars: {snippet}", 2)
+            finally:
+                r.close()
 
         if r.status_code in TRANSIENT_STATUSES or (500 <= r.status_code <= 599):
             ra = _retry_after_seconds(r) if r.status_code == 429 else None
+            r.close()
             last_err = f"HTTP {r.status_code}"
             _sleep_backoff(attempt, forced_min=ra)
             continue
@@ -133,41 +320,264 @@ def post_lookup(session: requests.Session, domain: str, limit: int, page_state:
     die(f"Failed after {MAX_RETRIES} retries. Last error: {last_err or 'unknown'}", 2)
 
 
+def iter_thc_candidates(session: requests.Session, domain: str) -> Iterable[str]:
+    page_state = ""
+
+    while True:
+        next_state = yield from post_lookup(session, domain, THC_PAGE_LIMIT, page_state)
+
+        if not next_state or next_state == page_state:
+            return
+
+        page_state = next_state
+        time.sleep(THC_PAGE_DELAY_SEC)
+
+
+# marks the end of one passive source on the candidate queue
+_SOURCE_DONE = object()
+
+
+def _produce_candidates(q: "queue.Queue[Any]", source: Callable[[], Iterable[str]]) -> None:
+    # errors (including die() from a source) are handed to the consumer to re-raise
+    try:
+        for host in source():
+            q.put(host)
+    except BaseException as e:
+        q.put(e)
+    finally:
+        q.put(_SOURCE_DONE)
+
+
 def _rand_label(n: int = 18) -> str:
     alphabet = string.ascii_lowercase + string.digits
     return "".join(random.choice(alphabet) for _ in range(n))
 
 
-def resolve_host_ips(host: str) -> FrozenSet[str]:
+def pack_ipset(ips: Iterable[str]) -> IPSet:
+    # sorted tuple of packed addresses: cheap to hash and compare as a wildcard signature
+    packed: Set[bytes] = set()
+    for ip in ips:
+        try:
+            packed.add(socket.inet_pton(socket.AF_INET6 if ":" in ip else socket.AF_INET, ip))
+        except (OSError, ValueError):
+            continue
+    return tuple(sorted(packed))
+
+
+def format_ipset(ipset: IPSet) -> str:
+    return ", ".join(
+        socket.inet_ntop(socket.AF_INET if len(ip) == 4 else socket.AF_INET6, ip) for ip in ipset
+    )
+
+
+# getaddrinfo errors that are a definitive "no such host / no such record"
+_GAI_NEGATIVE = {socket.EAI_NONAME, getattr(socket, "EAI_NODATA", socket.EAI_NONAME)}
+
+
+def resolve_host_ips(host: str, family: int = socket.AF_INET) -> Lookup:
+    # AF_INET by default: one A query per host instead of A + AAAA
     try:
-        infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
-    except socket.gaierror:
-        return frozenset()
+        infos = socket.getaddrinfo(host, None, family=family, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        return () if e.errno in _GAI_NEGATIVE else None
     except Exception:
-        return frozenset()
+        return None
 
-    ips: Set[str] = set()
+    ips: List[str] = []
     for _family, _socktype, _proto, _canonname, sockaddr in infos:
         if isinstance(sockaddr, tuple) and sockaddr:
             ip = sockaddr[0]
             if isinstance(ip, str) and ip:
-                ips.add(ip)
-    return frozenset(ips)
+                ips.append(ip)
+    return pack_ipset(ips)
+
+
+def _copy_task_result(fut: "Future[Any]", task: "asyncio.Task[Any]") -> None:
+    if task.cancelled():
+        fut.cancel()
+    elif task.exception() is not None:
+        fut.set_exception(task.exception())
+    else:
+        fut.set_result(task.result())
+
+
+class AsyncResolver:
+    """aiodns resolver driven by its own event loop thread.
+
+    One loop drives every query through c-ares, so thousands of lookups can
+    be in flight without a thread per lookup. submit() hands back a
+    concurrent Future so callers can wait on it like a thread-pool job.
+    """
+
+    def __init__(
+        self,
+        nameservers: Optional[List[str]] = None,
+        family: int = socket.AF_INET,
+        concurrency: int = MAX_DNS_CONCURRENCY,
+    ) -> None:
+        self._family = family
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="subhunt-dns", daemon=True).start()
+
+        async def _setup() -> Any:
+            return aiodns.DNSResolver(
+                nameservers=nameservers or None,
+                timeout=ASYNC_DNS_TIMEOUT_SEC,
+                tries=1,
+            )
+
+        self._resolver = asyncio.run_coroutine_threadsafe(_setup(), self._loop).result()
+        self.set_concurrency(concurrency)
+
+    def set_concurrency(self, n: int) -> None:
+        # semaphores must be created on the loop they guard (py3.8/3.9)
+        async def _make() -> asyncio.Semaphore:
+            return asyncio.Semaphore(n)
+
+        self._sem = asyncio.run_coroutine_threadsafe(_make(), self._loop).result()
+
+    async def _resolve(self, host: str) -> Tuple[str, Lookup]:
+        async with self._sem:
+            try:
+                res = await self._resolver.getaddrinfo(host, family=self._family, type=socket.SOCK_STREAM)
+            except aiodns.error.DNSError as e:
+                # only "no such host / no such record" is a real negative answer
+                negative = bool(e.args) and e.args[0] in (
+                    aiodns.error.ARES_ENOTFOUND,
+                    aiodns.error.ARES_ENODATA,
+                )
+                return (host, () if negative else None)
+            except Exception:
+                return (host, None)
+
+        ips: List[str] = []
+        for node in res.nodes:
+            addr = node.addr
+            if isinstance(addr, tuple) and addr:
+                ip = addr[0]
+                if isinstance(ip, bytes):
+                    ip = ip.decode("ascii", "ignore")
+                if isinstance(ip, str) and ip:
+                    ips.append(ip)
+        return (host, pack_ipset(ips))
+
+    def submit(self, host: str) -> "Future[Tuple[str, Lookup]]":
+        return asyncio.run_coroutine_threadsafe(self._resolve(host), self._loop)
+
+    def submit_many(self, hosts: List[str]) -> List["Future[Tuple[str, Lookup]]"]:
+        # a single call_soon_threadsafe (one self-pipe write) starts the whole
+        # batch, instead of one cross-thread wakeup per host
+        futures: List["Future[Tuple[str, Lookup]]"] = [Future() for _ in hosts]
+        self._loop.call_soon_threadsafe(self._start_batch, list(hosts), futures)
+        return futures
+
+    def _start_batch(self, hosts: List[str], futures: List["Future[Tuple[str, Lookup]]"]) -> None:
+        for host, fut in zip(hosts, futures):
+            task = self._loop.create_task(self._resolve(host))
+            task.add_done_callback(functools.partial(_copy_task_result, fut))
+
+    def close(self) -> None:
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+class DNSCache:
+    """SQLite-backed host -> IPSet cache in CACHE_DIR, keyed by host and address family.
+
+    Only used from the main thread. Writes are batched and committed every
+    DNS_CACHE_FLUSH_EVERY results and on close(). Wildcard probes never go
+    through the cache.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS dns ("
+            "host TEXT NOT NULL, family INTEGER NOT NULL, ips TEXT NOT NULL, expires REAL NOT NULL, "
+            "PRIMARY KEY (host, family))"
+        )
+        self._db.execute("DELETE FROM dns WHERE expires <= ?", (time.time(),))
+        self._db.commit()
+        self._pending: List[Tuple[str, int, str, float]] = []
+
+    def get(self, host: str, family: int) -> Optional[IPSet]:
+        try:
+            row = self._db.execute(
+                "SELECT ips FROM dns WHERE host = ? AND family = ? AND expires > ?",
+                (host, family, time.time()),
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        return pack_ipset(row[0].split(", ")) if row[0] else ()
+
+    def set(self, host: str, family: int, ipset: Lookup) -> None:
+        if ipset is None:
+            # transient failure: caching it would hide a live host next run
+            return
+        ttl = DNS_CACHE_TTL_SEC if ipset else DNS_CACHE_NEGATIVE_TTL_SEC
+        self._pending.append((host, family, format_ipset(ipset), time.time() + ttl))
+        if len(self._pending) >= DNS_CACHE_FLUSH_EVERY:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        try:
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO dns VALUES (?, ?, ?, ?)", self._pending)
+        except sqlite3.Error:
+            pass
+        self._pending = []
+
+    def close(self) -> None:
+        self.flush()
+        self._db.close()
+
+
+def open_dns_cache() -> Optional[DNSCache]:
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        return DNSCache(os.path.join(CACHE_DIR, "dns.sqlite"))
+    except (OSError, sqlite3.Error) as e:
+        print(f"Warning: DNS cache unavailable, resolving everything live: {e}", file=sys.stderr)
+        return None
 
 
-def detect_wildcard_signature(domain: str) -> Optional[FrozenSet[str]]:
-    ipsets: List[FrozenSet[str]] = []
+def detect_wildcard_signature(
+    domain: str,
+    resolve: Callable[[str], Lookup] = resolve_host_ips,
+    rtts: Optional[List[float]] = None,
+) -> Optional[IPSet]:
+    # rtts, if given, collects each probe's round-trip time for sizing concurrency
+    ipsets: List[Lookup] = []
     for _ in range(3):
         host = f"{_rand_label()}.{domain}"
-        ipset = resolve_host_ips(host)
+        started = time.monotonic()
+        ipset = resolve(host)
+        if rtts is not None:
+            rtts.append(time.monotonic() - started)
         if ipset:
             ipsets.append(ipset)
 
-    if len(ipsets) < 2:
+    return wildcard_from_ipsets(ipsets)
+
+
+def dns_concurrency(qps: int, median_rtt: float) -> int:
+    concurrency = max(MIN_DNS_CONCURRENCY, min(MAX_DNS_CONCURRENCY, int(qps * median_rtt)))
+    if median_rtt > SLOW_RESOLVER_RTT_SEC:
+        concurrency = min(concurrency, SLOW_RESOLVER_CONCURRENCY)
+    return concurrency
+
+
+def wildcard_from_ipsets(ipsets: List[Lookup]) -> Optional[IPSet]:
+    # at least two of the random-label probes must agree on a non-empty answer
+    answers = [s for s in ipsets if s]
+    if len(answers) < 2:
         return None
 
-    counts: Dict[FrozenSet[str], int] = {}
-    for s in ipsets:
+    counts: Dict[IPSet, int] = {}
+    for s in answers:
         counts[s] = counts.get(s, 0) + 1
 
     best_set, best_count = max(counts.items(), key=lambda kv: kv[1])
@@ -176,6 +586,17 @@ def detect_wildcard_signature(domain: str) -> Optional[FrozenSet[str]]:
     return None
 
 
+def _evict_cached(session: requests.Session, r: requests.Response) -> None:
+    # a CachedSession stores any 2xx; drop a body that did not parse so the
+    # retry (and the next run) goes back to the server
+    cache = getattr(session, "cache", None)
+    if cache is not None:
+        try:
+            cache.delete(requests=[r.request])
+        except Exception:
+            pass
+
+
 def _get_json_with_retries(session: requests.Session, url: str, params: dict) -> Any:
     headers = {"Accept": "application/json", "User-Agent": "subhunt/1.5"}
     last_err: Optional[str] = None
@@ -190,9 +611,10 @@ def _get_json_with_retries(session: requests.Session, url: str, params: dict) ->
 
         if 200 <= r.status_code < 300:
             try:
-                return r.json()
+                return _load_json(r)
             except Exception:
                 last_err = "Non-JSON response"
+                _evict_cached(session, r)
                 _sleep_backoff(attempt)
                 continue
 
@@ -208,6 +630,23 @@ def _get_json_with_retries(session: requests.Session, url: str, params: dict) ->
     return None
 
 
+def new_passive_session(use_cache: bool = True) -> requests.Session:
+    # crt.sh and Wayback GETs are idempotent and can be tens of MB; with
+    # requests-cache installed they are kept in CACHE_DIR and revalidated
+    # with ETag / Last-Modified once stale
+    if use_cache and requests_cache is not None:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            return requests_cache.CachedSession(
+                os.path.join(CACHE_DIR, "http"),
+                backend="sqlite",
+                expire_after=HTTP_CACHE_TTL_SEC,
+            )
+        except Exception as e:
+            print(f"Warning: HTTP cache unavailable: {e}", file=sys.stderr)
+    return requests.Session()
+
+
 def fetch_wayback_candidates(session: requests.Session, domain: str) -> Iterable[str]:
     params = {
         "url": f"*.{domain}/*",
@@ -253,22 +692,34 @@ def fetch_crtsh_candidates(session: requests.Session, domain: str) -> Iterable[s
             name_value = entry.get("name_value")
             if not isinstance(name_value, str) or not name_value:
                 continue
-            for host in name_value.splitlines():
-                host = host.strip().lower().rstrip(".")
-                if host:
-                    if host.startswith("*."):
-                        host = host[2:]
-                    out.append(host)
+            out.extend(m.group(1) for m in CRTSH_NAME_RE.finditer(name_value.lower()))
         except Exception:
             continue
 
     return out
 
 
+# the results table is assembled as raw WordprocessingML and parsed once;
+# styling every cell through python-docx properties is very slow on big tables
+_DOCX_CELL_XML = (
+    '<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="4320"/></w:tcPr>'
+    '<w:p><w:r><w:rPr><w:rFonts w:ascii="Calibri Light" w:hAnsi="Calibri Light"/><w:sz w:val="18"/></w:rPr>'
+    "<w:t>{}</w:t></w:r></w:p></w:tc>"
+)
+_DOCX_TABLE_HEAD_XML = (
+    '<w:tbl {}><w:tblPr><w:tblStyle w:val="TableGrid"/><w:tblW w:type="auto" w:w="0"/>'
+    '<w:tblLook w:val="04A0" w:firstRow="1" w:lastRow="0" w:firstColumn="1" w:lastColumn="0"'
+    ' w:noHBand="0" w:noVBand="1"/></w:tblPr>'
+    '<w:tblGrid><w:gridCol w:w="4320"/><w:gridCol w:w="4320"/></w:tblGrid>'
+)
+
+
 def _write_docx(path: str, domain: str, rows: List[Tuple[str, str]]) -> None:
     try:
         from docx import Document  # type: ignore
         from docx.shared import Pt  # type: ignore
+        from docx.oxml import parse_xml  # type: ignore
+        from docx.oxml.ns import nsdecls  # type: ignore
     except Exception:
         print("Warning: python-docx not installed; cannot write DOCX output.", file=sys.stderr)
         return
@@ -283,29 +734,16 @@ def _write_docx(path: str, domain: str, rows: List[Tuple[str, str]]) -> None:
         run.font.name = "Calibri Light"
         run.font.size = Pt(9)
 
-    doc.add_paragraph("")
+    spacer = doc.add_paragraph("")
 
-    table = doc.add_table(rows=len(rows) + 1, cols=2)
-    table.style = "Table Grid"
-    hdr = table.rows[0].cells
-    hdr[0].text = "Subdomain"
-    hdr[1].text = "IPs"
-
-    def style_cell_text(cell):
-        for p in cell.paragraphs:
-            for run in p.runs:
-                run.font.name = "Calibri Light"
-                run.font.size = Pt(9)
-
-    style_cell_text(hdr[0])
-    style_cell_text(hdr[1])
-
-    for i, (host, ips) in enumerate(rows, start=1):
-        c0, c1 = table.rows[i].cells
-        c0.text = host
-        c1.text = ips
-        style_cell_text(c0)
-        style_cell_text(c1)
+    parts = [_DOCX_TABLE_HEAD_XML.format(nsdecls("w"))]
+    for host, ips in [("Subdomain", "IPs")] + rows:
+        parts.append("<w:tr>")
+        parts.append(_DOCX_CELL_XML.format(xml_escape(host)))
+        parts.append(_DOCX_CELL_XML.format(xml_escape(ips)))
+        parts.append("</w:tr>")
+    parts.append("</w:tbl>")
+    spacer._p.addnext(parse_xml("".join(parts)))
 
     try:
         doc.save(path)
@@ -326,6 +764,27 @@ def _parse_args(argv: List[str]) -> argparse.Namespace:
         action="store_true",
         help="Also use Wayback CDX + crt.sh (slower, more coverage)",
     )
+    p.add_argument(
+        "--nameservers",
+        default=None,
+        help="Comma-separated DNS servers for the live filter, e.g. 1.1.1.1,8.8.8.8 (requires aiodns >= 3.2)",
+    )
+    p.add_argument(
+        "--qps",
+        type=int,
+        default=DEFAULT_DNS_QPS,
+        help=f"Target DNS queries per second; concurrency is sized from this and the resolver RTT (default {DEFAULT_DNS_QPS})",
+    )
+    p.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"Do not read or write the on-disk cache in {CACHE_DIR}",
+    )
+    p.add_argument(
+        "--ipv6",
+        action="store_true",
+        help="Also look up AAAA records (hosts that only have IPv6 addresses are kept)",
+    )
     return p.parse_args(argv[1:])
 
 
@@ -341,42 +800,134 @@ def main(argv: Optional[List[str]] = None) -> None:
 
     out_docx = (args.output.strip() if isinstance(args.output, str) else None) if args.output else None
 
-    session = requests.Session()
-    wildcard_sig = detect_wildcard_signature(domain)
+    family = socket.AF_UNSPEC if args.ipv6 else socket.AF_INET
+    nameservers = [ns.strip() for ns in (args.nameservers or "").split(",") if ns.strip()]
+    for ns in nameservers:
+        try:
+            ipaddress.ip_address(ns)
+        except ValueError:
+            die(f"Invalid --nameservers entry: {ns!r} (expected an IP address)")
+
+    async_resolver: Optional[AsyncResolver] = None
+    if aiodns is not None:
+        async_resolver = AsyncResolver(nameservers, family)
+    elif nameservers:
+        print("Warning: aiodns >= 3.2 not installed; ignoring --nameservers and using the system resolver.", file=sys.stderr)
+
+    def resolve(h: str) -> Lookup:
+        if async_resolver is not None:
+            return async_resolver.submit(h).result()[1]
+        return resolve_host_ips(h, family)
+
+    rtts: List[float] = []
+    wildcard_sig = detect_wildcard_signature(domain, resolve, rtts)
+
+    # size DNS concurrency from the probe RTTs (Little's law). A slow default
+    # resolver is compared against public ones, and the faster one is kept.
+    median_rtt = statistics.median(rtts)
+    if median_rtt > SLOW_RESOLVER_RTT_SEC and async_resolver is not None and not nameservers:
+        original, original_sig = async_resolver, wildcard_sig
+        async_resolver = AsyncResolver(PUBLIC_NAMESERVERS, family)
+        public_rtts: List[float] = []
+        public_sig = detect_wildcard_signature(domain, resolve, public_rtts)
+        public_rtt = statistics.median(public_rtts)
+        if public_rtt < median_rtt:
+            print(
+                f"Note: resolver is slow ({median_rtt * 1000:.0f} ms); switching to "
+                f"{','.join(PUBLIC_NAMESERVERS)} ({public_rtt * 1000:.0f} ms)",
+                file=sys.stderr,
+            )
+            original.close()
+            wildcard_sig, median_rtt = public_sig, public_rtt
+        else:
+            async_resolver.close()
+            async_resolver, wildcard_sig = original, original_sig
+
+    concurrency = dns_concurrency(args.qps, median_rtt)
+    if async_resolver is not None:
+        async_resolver.set_concurrency(concurrency)
+
+    # learned wildcards below the target. Live hosts under a parent that is not
+    # classified yet are held back; when WILDCARD_LEARN_THRESHOLD of them share
+    # an IP set, the parent is probed through the resolver like any other
+    # lookup. The probe result filters the held hosts retroactively; later
+    # hosts under a classified parent are still resolved and compared against
+    # its signature, so hosts with their own records survive in any order.
+    # Hosts under parents that never reach the threshold are released at the end.
+    parent_sigs: Dict[str, Optional[IPSet]] = {}
+    held: Dict[str, List[Tuple[str, IPSet]]] = {}
+    parent_hits: Dict[Tuple[str, IPSet], int] = {}
+    probes: Dict[Future, str] = {}
+    probe_results: Dict[str, List[Lookup]] = {}
+
+    suffix = "." + domain
 
     def is_in_scope(host: str) -> bool:
-        return host == domain or host.endswith("." + domain)
+        return host == domain or host.endswith(suffix)
 
     found_rows: List[Tuple[str, str]] = []
     found_set: Set[str] = set()
+    # many hosts share one IP set (CDNs, load balancers): format each set once
+    # and reuse the same string object for every row
+    ipset_text: Dict[IPSet, str] = {}
+
+    dns_cache = None if args.no_cache else open_dns_cache()
 
-    def resolve_pair(h: str) -> Tuple[str, FrozenSet[str]]:
-        return (h, resolve_host_ips(h))
+    def resolve_pair(h: str) -> Tuple[str, Lookup]:
+        return (h, resolve_host_ips(h, family))
 
-    with ThreadPoolExecutor(max_workers=DNS_WORKERS) as ex:
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
         inflight = set()
+        unflushed = 0
 
-        def submit_candidate(host: str):
-            return ex.submit(resolve_pair, host)
+        def flush_output() -> None:
+            nonlocal unflushed
+            if unflushed:
+                sys.stdout.flush()
+                unflushed = 0
 
-        def record_and_print(host: str, ipset: FrozenSet[str]) -> None:
+        batch: List[str] = []
+
+        def submit_batch() -> None:
+            if batch:
+                inflight.update(async_resolver.submit_many(batch))
+                batch.clear()
+
+        def submit_candidate(host: str) -> None:
+            if async_resolver is None:
+                inflight.add(ex.submit(resolve_pair, host))
+                return
+            batch.append(host)
+            if len(batch) >= DNS_SUBMIT_BATCH:
+                submit_batch()
+
+        def record_and_print(host: str, ipset: IPSet) -> None:
+            nonlocal unflushed
             if host in found_set:
                 return
             found_set.add(host)
 
-            print(host, flush=True)
+            sys.stdout.write(host + "\n")
+            unflushed += 1
+            if unflushed >= OUTPUT_FLUSH_EVERY:
+                flush_output()
 
             if out_docx is None:
                 return
 
-            ips = ", ".join(sorted(ipset)) if ipset else ""
+            ips = ipset_text.get(ipset)
+            if ips is None:
+                ips = ipset_text[ipset] = format_ipset(ipset)
             found_rows.append((host, ips))
 
         def drain_some(block: bool) -> None:
             nonlocal inflight
+            submit_batch()
             if not inflight:
                 return
 
+            if block:
+                flush_output()
             timeout = None if block else 0
             done, pending = wait(inflight, timeout=timeout, return_when=FIRST_COMPLETED)
 
@@ -388,12 +939,61 @@ def main(argv: Optional[List[str]] = None) -> None:
                 try:
                     host, ipset = f.result()
                 except Exception:
+                    host, ipset = "", None
+                parent = probes.pop(f, None)
+                if parent is not None:
+                    handle_probe(parent, ipset)
                     continue
-                if not ipset:
-                    continue
-                if wildcard_sig is not None and ipset == wildcard_sig:
+                if not host:
                     continue
+                if dns_cache is not None:
+                    dns_cache.set(host, family, ipset)
+                handle_result(host, ipset)
+
+        def start_probe(parent: str) -> None:
+            probe_hosts = [f"{_rand_label()}.{parent}" for _ in range(3)]
+            if async_resolver is not None:
+                futures = async_resolver.submit_many(probe_hosts)
+            else:
+                futures = [ex.submit(resolve_pair, h) for h in probe_hosts]
+            probe_results[parent] = []
+            for f in futures:
+                probes[f] = parent
+                inflight.add(f)
+
+        def handle_probe(parent: str, ipset: Lookup) -> None:
+            results = probe_results[parent]
+            results.append(ipset)
+            if len(results) < 3:
+                return
+            del probe_results[parent]
+            sig = wildcard_from_ipsets(results)
+            parent_sigs[parent] = sig
+            for host, host_ipset in held.pop(parent, []):
+                if sig is None or host_ipset != sig:
+                    record_and_print(host, host_ipset)
+
+        def handle_result(host: str, ipset: Lookup) -> None:
+            if not ipset:
+                return
+            if wildcard_sig is not None and ipset == wildcard_sig:
+                return
+
+            parent = host.partition(".")[2]
+            if host == domain or parent == domain:
                 record_and_print(host, ipset)
+                return
+            if parent in parent_sigs:
+                if ipset != parent_sigs[parent]:
+                    record_and_print(host, ipset)
+                return
+
+            held.setdefault(parent, []).append((host, ipset))
+            key = (parent, ipset)
+            hits = parent_hits.get(key, 0) + 1
+            parent_hits[key] = hits
+            if hits == WILDCARD_LEARN_THRESHOLD and parent not in probe_results:
+                start_probe(parent)
 
         def enqueue(host: str, seen: Set[str]) -> None:
             host = host.strip().lower().rstrip(".")
@@ -403,50 +1003,73 @@ def main(argv: Optional[List[str]] = None) -> None:
                 return
             seen.add(host)
 
-            inflight.add(submit_candidate(host))
+            if dns_cache is not None:
+                cached = dns_cache.get(host, family)
+                if cached is not None:
+                    handle_result(host, cached)
+                    return
+
+            submit_candidate(host)
             while len(inflight) >= MAX_INFLIGHT:
                 drain_some(block=True)
 
         seen: Set[str] = set()
 
-        # -------- Passive source #1: THC (default) --------------------
-        page_state = ""
-        limit = 500
-
-        while True:
-            obj = post_lookup(session, domain, limit, page_state)
-            for s in extract_domains(obj):
-                enqueue(s, seen)
-
-            next_state = find_next_page_state(obj)
-            if not next_state or next_state == page_state:
-                break
-
-            page_state = next_state
-            time.sleep(0.15)
-
-            for _ in range(4):
-                if not inflight:
-                    break
+        # -------- Passive sources, fetched concurrently ---------------
+        # THC is the default source; Wayback CDX + crt.sh only with --full.
+        # Each source gets its own session and streams hosts into one queue
+        # that feeds the resolver, so total time tracks the slowest source.
+        sources: List[Callable[[], Iterable[str]]] = [
+            lambda: iter_thc_candidates(requests.Session(), domain),
+        ]
+        if args.full:
+            use_cache = not args.no_cache
+            sources.append(lambda: fetch_wayback_candidates(new_passive_session(use_cache), domain))
+            sources.append(lambda: fetch_crtsh_candidates(new_passive_session(use_cache), domain))
+
+        candidates: "queue.Queue[Any]" = queue.Queue()
+        for source in sources:
+            threading.Thread(
+                target=_produce_candidates, args=(candidates, source), daemon=True
+            ).start()
+
+        active = len(sources)
+        while active:
+            if not inflight:
+                submit_batch()
+                flush_output()
+            try:
+                item = candidates.get(timeout=(0.05 if inflight else None))
+            except queue.Empty:
+                flush_output()
                 drain_some(block=False)
+                continue
 
-        # -------- Optional extra sources (only with --full) -------
-        if args.full:
-            for s in fetch_wayback_candidates(session, domain):
-                enqueue(s, seen)
-                if inflight and random.random() < 0.08:
-                    drain_some(block=False)
+            if item is _SOURCE_DONE:
+                active -= 1
+                continue
+            if isinstance(item, BaseException):
+                raise item
 
-            for s in fetch_crtsh_candidates(session, domain):
-                enqueue(s, seen)
-                if inflight and random.random() < 0.08:
-                    drain_some(block=False)
+            enqueue(item, seen)
+            if inflight and random.random() < 0.08:
+                drain_some(block=False)
 
+        submit_batch()
         while inflight:
             drain_some(block=True)
 
+        for rows in held.values():
+            for host, ipset in rows:
+                record_and_print(host, ipset)
+        flush_output()
+
+    if dns_cache is not None:
+        dns_cache.close()
+
     if out_docx is not None:
-        found_rows.sort(key=lambda x: x[0])
+        # hierarchical order: compare labels right to left so zones stay together
+        found_rows.sort(key=lambda row: row[0].split(".")[::-1])
         _write_docx(out_docx, domain, found_rows)
 
 